@@ -1,17 +1,14 @@
-from zipfile import ZipFile
-import io
-import sys
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+import tempfile
 import traceback
 
-import fitz
 import streamlit as st
 from loguru import logger
 
 from config import *
 from helpers import *
-from journals import orgsci
 
-logger.add(sys.stdout, backtrace=True, diagnose=True)
+add_stdout_log_sink()
 
 if "convert_clicked" not in st.session_state:
     st.session_state["convert_clicked"] = False
@@ -56,8 +53,7 @@ uploaded_pdf_editor = st.data_editor(
 
 convert_button = st.button(
     "⚙️ Convert",
-    disabled=(not all(uploaded_pdf_editor.get("Journal", [None])))
-    or len(pdf_files) == 0,
+    disabled=not st.session_state.get("all_journals_set", False),
     on_click=set_converted_state,
     args=(True,),
 )
@@ -65,69 +61,91 @@ convert_button = st.button(
 st.write("---")
 st.header("Results")
 
-zip_buffer = io.BytesIO()
-pdf_file_zip = ZipFile(zip_buffer, mode="w")
+compress_zip = st.sidebar.checkbox(
+    'Compress the "Download All" archive',
+    value=True,
+    help="Uses fast (level 1) DEFLATE compression. Untick to store the CSV "
+    "files uncompressed, which skips compression work at the cost of a larger "
+    "download.",
+)
 
 # Show results if either:
 #   1. convert button is clicked
 #   2. "convert_clicked" state is still True (False when we upload new files)
 if convert_button or st.session_state["convert_clicked"]:
-    uploaded_pdfs = uploaded_pdf_editor.to_dict(orient="records")
-    for pdf_info, pdf_file in zip(uploaded_pdfs, pdf_files):
-        journal = pdf_info["Journal"]
-        pdf_file_contents = pdf_file.getvalue()
-        doc = fitz.open("pdf", pdf_file_contents)
-        try:
-            sections_df, references_df = journal_map[journal](doc)
-
-            # Add created_files to zip
-            with pdf_file_zip.open(
-                f"{pdf_file.name[:-4]}_sections.csv", "w"
-            ) as sections_csv:
-                orgsci.sanitize_dataframe_for_download(sections_df).to_csv(sections_csv)
-            with pdf_file_zip.open(
-                f"{pdf_file.name[:-4]}_references.csv", "w"
-            ) as references_csv:
-                orgsci.sanitize_dataframe_for_download(references_df).to_csv(
-                    references_csv
-                )
-
-            # Success in expander
-            with st.expander(f"✅{pdf_file.name}"):
-                st.subheader("Sections")
-                sections_display = st.dataframe(sections_df)
-                sections_download_button = st.download_button(
-                    label="Download",
-                    data=orgsci.sanitize_dataframe_for_download(sections_df).to_csv(),
-                    file_name=f"{doc.name}_sections.csv",
-                )
-                st.subheader("References")
-                references_display = st.dataframe(references_df)
-                references_download_button = st.download_button(
-                    label="Download",
-                    data=orgsci.sanitize_dataframe_for_download(references_df).to_csv(),
-                    file_name=f"{doc.name}_references.csv",
-                )
-        except Exception as e:
+    jobs = get_pdf_jobs(pdf_files, uploaded_pdf_editor["Journal"].tolist())
+    conversions = convert_pdfs(jobs)
+
+    # Spill the archive to disk while it is built once it grows past 64 MB
+    zip_buffer = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024)
+    if compress_zip:
+        pdf_file_zip = ZipFile(
+            zip_buffer, mode="w", compression=ZIP_DEFLATED, compresslevel=1
+        )
+    else:
+        pdf_file_zip = ZipFile(zip_buffer, mode="w", compression=ZIP_STORED)
+
+    for pdf_file, (pdf_hash, journal, _) in zip(pdf_files, jobs):
+        conversion = conversions[(journal, pdf_hash)]
+        # Failed conversions are kept across reruns and were logged when they
+        # happened, so they are shown without being raised and logged again
+        error = conversion if isinstance(conversion, Exception) else None
+        if error is None:
+            try:
+                sections_df, references_df, sections_csv, references_csv = conversion
+                if pdf_file.name.lower().endswith(".pdf"):
+                    base_name = pdf_file.name[:-4]
+                else:
+                    base_name = pdf_file.name
+
+                # Add created_files to zip
+                pdf_file_zip.writestr(f"{base_name}_sections.csv", sections_csv)
+                pdf_file_zip.writestr(f"{base_name}_references.csv", references_csv)
+
+                # Success in expander
+                with st.expander(f"✅{pdf_file.name}"):
+                    st.subheader("Sections")
+                    sections_display = st.dataframe(sections_df)
+                    sections_download_button = st.download_button(
+                        label="Download",
+                        data=sections_csv,
+                        file_name=f"{base_name}_sections.csv",
+                    )
+                    st.subheader("References")
+                    references_display = st.dataframe(references_df)
+                    references_download_button = st.download_button(
+                        label="Download",
+                        data=references_csv,
+                        file_name=f"{base_name}_references.csv",
+                    )
+            except Exception as e:
+                logger.opt(exception=e).error(f"Exception found: {e}")
+                error = e
+
+        if error is not None:
             # Error in expander
             with st.expander(f"⚠️{pdf_file.name}"):
                 NEWLINE = "\n\n"
+                traceback_text = NEWLINE.join(traceback.format_exception(error))
                 st.error(
                     "Whoops! There seems to be an error. Did you make sure that the journal selected matches the file you uploaded?\n\n\n"
                     + "============ \n\n\n"
-                    + f"Traceback: {NEWLINE.join(traceback.format_exception(e))}"
+                    + f"Traceback: {traceback_text}"
                 )
-                logger.error(f"Exception found: {e.with_traceback(e.__traceback__)}")
-
-# Close the zip file
-pdf_file_zip.close()
 
-download_all_button = st.download_button(
-    label="Download All",
-    data=zip_buffer.getvalue(),
-    file_name="paper-sense-results.zip",
-    mime="application/zip",
-)
+    # Close the zip file and keep its contents for the "Download All" button
+    pdf_file_zip.close()
+    zip_buffer.seek(0)
+    st.session_state["zip_bytes"] = zip_buffer.read()
+    zip_buffer.close()
+
+if "zip_bytes" in st.session_state:
+    download_all_button = st.download_button(
+        label="Download All",
+        data=st.session_state["zip_bytes"],
+        file_name="paper-sense-results.zip",
+        mime="application/zip",
+    )
 
 
 st.markdown("---")
@@ -1,4 +1,4 @@
-from journals import annurev, aom, asq, orgsci, jom, joap, personnel
+import importlib
 
 APP_DESCRIPTION = (
     "A program that takes in management academic research PDF files "
@@ -38,12 +38,45 @@ JOURNALS = [
 
 DEFAULT_OPTION, ORGSCI, ANNUREV_ORGPSYCH, AOM, ASQ, JOM, JOAP, PERSONNEL = JOURNALS
 
+# Journal modules are only imported when a PDF of that journal is converted
 journal_map = {
-    ORGSCI: orgsci.convert_pdf_to_dataframes,
-    ANNUREV_ORGPSYCH: annurev.convert_pdf_to_dataframes,
-    AOM: aom.convert_pdf_to_dataframes,
-    ASQ: asq.convert_pdf_to_dataframes,
-    JOM: jom.convert_pdf_to_dataframes,
-    JOAP: joap.convert_pdf_to_dataframes,
-    PERSONNEL: personnel.convert_pdf_to_dataframes,
+    ORGSCI: "journals.orgsci",
+    ANNUREV_ORGPSYCH: "journals.annurev",
+    AOM: "journals.aom",
+    ASQ: "journals.asq",
+    JOM: "journals.jom",
+    JOAP: "journals.joap",
+    PERSONNEL: "journals.personnel",
 }
+
+# Only OrgSci and Annurev-Orgpsych ship their own sanitizer; the other
+# journals use the OrgSci one
+sanitize_map = {journal: "journals.orgsci" for journal in journal_map}
+sanitize_map[ANNUREV_ORGPSYCH] = "journals.annurev"
+
+
+def get_converter(journal):
+    """
+    Get the PDF-to-DataFrames function of a journal, importing its module.
+
+    Parameters:
+        journal (str): The journal the PDF belongs to.
+
+    Returns:
+        callable: The journal's `convert_pdf_to_dataframes` function.
+    """
+    return importlib.import_module(journal_map[journal]).convert_pdf_to_dataframes
+
+
+def get_sanitizer(journal):
+    """
+    Get the function that prepares a journal's DataFrames for download.
+
+    Parameters:
+        journal (str): The journal the PDF belongs to.
+
+    Returns:
+        callable: The `sanitize_dataframe_for_download` function to use.
+    """
+    module = importlib.import_module(sanitize_map[journal])
+    return module.sanitize_dataframe_for_download
@@ -1,10 +1,39 @@
+import hashlib
+import multiprocessing
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
 import streamlit as st
+from loguru import logger
+
+from config import get_converter, get_sanitizer
+
+
+@st.cache_resource
+def add_stdout_log_sink():
+    """
+    Add the stdout sink to the logger once per server process.
+
+    Streamlit reruns the script on every interaction, so adding the sink at
+    module level would attach one more duplicate sink on each rerun.
+
+    Returns:
+        int: The loguru handler id of the sink.
+    """
+    return logger.add(sys.stdout, backtrace=True, diagnose=True)
 
 
 def set_converted_state(state):
     """
     Set the state of the "convert_clicked" key in the session state dictionary.
 
+    Resetting the state also drops the "Download All" archive and the
+    temporary PDF files of the previous conversion, so they are not reused
+    for a different set of files.
+
     Parameters:
     - state: The new state to set for the "convert_clicked" key.
 
@@ -12,6 +41,11 @@ def set_converted_state(state):
     None
     """
     st.session_state["convert_clicked"] = state
+    if not state:
+        st.session_state.pop("zip_bytes", None)
+        st.session_state.pop("pdf_hashes", None)
+        for pdf_source in st.session_state.pop("pdf_paths", {}).values():
+            remove_pdf_tempfile(pdf_source)
 
 
 def save_editor_changes():
@@ -27,29 +61,56 @@ def save_editor_changes():
     pdf_dataframe = st.session_state["pdf_dataframe"]
     updates = st.session_state["pdf_editor"]["edited_rows"]
     # Save the updated dataframe in the session state
-    for idx, journal_dict in updates.items():
-        for key in journal_dict:
-            journal = journal_dict[key]
-        pdf_dataframe.at[idx, "Journal"] = journal
+    edits = {
+        int(idx): journal_dict["Journal"]
+        for idx, journal_dict in updates.items()
+        if "Journal" in journal_dict
+    }
+    if edits:
+        pdf_dataframe.loc[list(edits), "Journal"] = list(edits.values())
 
-    pdf_to_journal_records = pdf_dataframe.to_dict(orient="records")
     # Update the session state's pdf-to-journal matches
-    for record in pdf_to_journal_records:
-        filename, journal = list(record.values())
-        st.session_state["pdf_to_journal_map"][filename] = journal
+    st.session_state["pdf_to_journal_map"].update(
+        zip(pdf_dataframe["Filename"].values, pdf_dataframe["Journal"].values)
+    )
+
+    update_all_journals_set(pdf_dataframe)
+
+
+def update_all_journals_set(pdf_dataframe):
+    """
+    Record in the session state whether every uploaded PDF has a journal.
+
+    The convert button reads the stored flag instead of checking every row of
+    the editor on each rerun.
+
+    Parameters:
+        pdf_dataframe (pandas.DataFrame): The filename-to-journal DataFrame.
+
+    Returns:
+    None
+    """
+    journal_column = pdf_dataframe["Journal"]
+    st.session_state["all_journals_set"] = (
+        bool(len(pdf_dataframe))
+        and not journal_column.isna().any()
+        and bool((journal_column != "").all())
+    )
 
 
 def create_pdf_dataframe(pdf_files):
     """
     Create a pandas DataFrame from a list of PDF files.
 
+    The DataFrame is rebuilt only when the uploaded files or their journals
+    change; otherwise the one from the previous rerun is returned.
+
     Parameters:
         pdf_files (list): A list of PDF files.
 
     Returns:
         pdf_dataframe (pandas.DataFrame): A DataFrame containing the filenames and journals of the PDF files.
     """
-    import pandas as pd
     if "pdf_to_journal_map" not in st.session_state:
         st.session_state["pdf_to_journal_map"] = {}
 
@@ -64,10 +125,264 @@ def create_pdf_dataframe(pdf_files):
         pdf_file_names.append(filename)
         journals.append(journal)
 
+    pdf_dataframe_key = (
+        tuple(pdf_file_names),
+        tuple(pdf_file.size for pdf_file in pdf_files),
+        tuple(journals),
+    )
+    if (
+        "pdf_dataframe" in st.session_state
+        and st.session_state.get("pdf_dataframe_key") == pdf_dataframe_key
+    ):
+        return st.session_state["pdf_dataframe"]
+
     pdf_dataframe = pd.DataFrame(
         {"Filename": pdf_file_names, "Journal": journals})
 
     # Save current dataframe in session state
     st.session_state['pdf_dataframe'] = pdf_dataframe
+    st.session_state["pdf_dataframe_key"] = pdf_dataframe_key
+    update_all_journals_set(pdf_dataframe)
 
     return pdf_dataframe
+
+
+def content_hash(pdf_bytes):
+    """
+    Compute a short digest identifying the contents of a PDF file.
+
+    Parameters:
+        pdf_bytes (bytes): The contents of the PDF file.
+
+    Returns:
+        str: The hex digest of the contents.
+    """
+    return hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+
+
+def get_pdf_tempdir():
+    """
+    Get the temporary directory that holds this session's uploaded PDFs.
+
+    The directory is kept in the session state. It is removed with all its
+    files when the session state is garbage collected after the session ends,
+    or when the server process exits, so PDFs that are still uploaded when a
+    session is closed do not pile up in the system temporary directory.
+
+    Returns:
+        str: The path of the directory.
+    """
+    if "pdf_tempdir" not in st.session_state:
+        st.session_state["pdf_tempdir"] = tempfile.TemporaryDirectory(
+            prefix="research-paper-parser-"
+        )
+    return st.session_state["pdf_tempdir"].name
+
+
+def write_pdf_to_tempfile(pdf_bytes):
+    """
+    Write the contents of an uploaded PDF to a temporary file in the
+    session's temporary directory.
+
+    Parameters:
+        pdf_bytes (bytes): The contents of the PDF file.
+
+    Returns:
+        str or bytes: The path of the temporary file, or `pdf_bytes` itself if
+        the directory or the file could not be created.
+    """
+    try:
+        with tempfile.NamedTemporaryFile(
+            delete=False, suffix=".pdf", dir=get_pdf_tempdir()
+        ) as pdf_tempfile:
+            pdf_tempfile.write(pdf_bytes)
+        return pdf_tempfile.name
+    except OSError:
+        return pdf_bytes
+
+
+def remove_pdf_tempfile(pdf_source):
+    """
+    Delete a temporary file created by `write_pdf_to_tempfile`.
+
+    Parameters:
+        pdf_source (str, bytes or None): The path of the temporary file, the
+        PDF contents if no file could be created, or None if the upload was
+        never written.
+
+    Returns:
+    None
+    """
+    if isinstance(pdf_source, str):
+        try:
+            os.remove(pdf_source)
+        except OSError:
+            pass
+
+
+def get_upload_id(pdf_file):
+    """
+    Get the id Streamlit gave to one upload of a file.
+
+    A file that is removed and uploaded again gets a new id, even when it has
+    the same name and size. Newer Streamlit releases call it `file_id`, the
+    pinned 1.25 release calls it `id`.
+
+    Parameters:
+        pdf_file (UploadedFile): The uploaded file.
+
+    Returns:
+        str or int: The id of the upload.
+    """
+    return getattr(pdf_file, "file_id", None) or pdf_file.id
+
+
+def get_pdf_jobs(pdf_files, journals):
+    """
+    Build the conversion jobs for the uploaded PDFs.
+
+    Each upload is read and hashed once, and its content hash is kept in the
+    session state under the upload's id.
+
+    Parameters:
+        pdf_files (list): The uploaded PDF files.
+        journals (list): The journal selected for each PDF file.
+
+    Returns:
+        list: A list of (content_hash, journal, pdf_file) tuples, one per file.
+    """
+    if "pdf_hashes" not in st.session_state:
+        st.session_state["pdf_hashes"] = {}
+    pdf_hashes = st.session_state["pdf_hashes"]
+
+    jobs = []
+    for pdf_file, journal in zip(pdf_files, journals):
+        key = get_upload_id(pdf_file)
+        if key not in pdf_hashes:
+            pdf_hashes[key] = content_hash(pdf_file.getvalue())
+        jobs.append((pdf_hashes[key], journal, pdf_file))
+
+    # Forget files that are no longer uploaded
+    current_keys = {get_upload_id(pdf_file) for pdf_file in pdf_files}
+    pdf_paths = st.session_state.get("pdf_paths", {})
+    for key in list(pdf_hashes):
+        if key not in current_keys:
+            del pdf_hashes[key]
+            remove_pdf_tempfile(pdf_paths.pop(key, None))
+
+    return jobs
+
+
+def get_pdf_source(pdf_file):
+    """
+    Get the source a worker process should parse an uploaded PDF from.
+
+    The upload's contents are written to a temporary file the first time it
+    actually has to be parsed, and the path is kept in the session state under
+    the upload's id. Parsing from a file path lets MuPDF read the file
+    directly and avoids sending the PDF bytes to the worker processes.
+
+    Parameters:
+        pdf_file (UploadedFile): The uploaded PDF file.
+
+    Returns:
+        str or bytes: The path of the temporary file, or the PDF bytes if the
+        file could not be created.
+    """
+    if "pdf_paths" not in st.session_state:
+        st.session_state["pdf_paths"] = {}
+    pdf_paths = st.session_state["pdf_paths"]
+
+    key = get_upload_id(pdf_file)
+    if key not in pdf_paths:
+        pdf_paths[key] = write_pdf_to_tempfile(pdf_file.getvalue())
+    return pdf_paths[key]
+
+
+def _parse_one(pdf_source, journal):
+    """
+    Convert a single PDF into its DataFrames and download-ready CSVs.
+
+    This runs inside worker processes, so it only takes picklable arguments
+    and opens the document itself.
+
+    Parameters:
+        pdf_source (str or bytes): The path of the PDF file, or its contents.
+        journal (str): The journal the PDF belongs to.
+
+    Returns:
+        tuple: The sections and references DataFrames, followed by their
+        sanitized CSV payloads as UTF-8 bytes.
+    """
+    import fitz
+
+    parse = get_converter(journal)
+    sanitize = get_sanitizer(journal)
+    if isinstance(pdf_source, str):
+        doc = fitz.open(pdf_source)
+    else:
+        doc = fitz.open("pdf", pdf_source)
+    sections_df, references_df = parse(doc)
+    sections_csv = sanitize(sections_df).to_csv().encode()
+    references_csv = sanitize(references_df).to_csv().encode()
+    return sections_df, references_df, sections_csv, references_csv
+
+
+def convert_pdfs(jobs):
+    """
+    Convert uploaded PDFs, parsing them in parallel when several need it.
+
+    Conversions are kept in the session state keyed on (journal, content
+    hash), so reruns only parse PDFs whose contents or journal changed. Failed
+    conversions are kept as well, so a PDF that cannot be parsed is not parsed
+    and logged again on every rerun.
+
+    Parameters:
+        jobs (list): A list of (content_hash, journal, pdf_file) tuples.
+
+    Returns:
+        dict: Maps (journal, content_hash) to the result of `_parse_one`, or
+        to the exception raised while converting that PDF.
+    """
+    if "conversions" not in st.session_state:
+        st.session_state["conversions"] = {}
+    conversions = st.session_state["conversions"]
+
+    outcomes = {}
+    pending = {}
+    for pdf_hash, journal, pdf_file in jobs:
+        key = (journal, pdf_hash)
+        if key in conversions:
+            outcomes[key] = conversions[key]
+        elif key not in pending:
+            # Only PDFs that still have to be parsed are written to disk
+            pending[key] = get_pdf_source(pdf_file)
+
+    if len(pending) > 1:
+        max_workers = min(os.cpu_count() or 1, 4, len(pending))
+        # Forking the multithreaded Streamlit server could copy locks held by
+        # other threads into the workers, so they are spawned instead
+        with ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = {
+                executor.submit(_parse_one, pdf_source, journal): (journal, pdf_hash)
+                for (journal, pdf_hash), pdf_source in pending.items()
+            }
+            for future in as_completed(futures):
+                try:
+                    outcomes[futures[future]] = future.result()
+                except Exception as e:
+                    logger.opt(exception=e).error(f"Exception found: {e}")
+                    outcomes[futures[future]] = e
+    else:
+        for (journal, pdf_hash), pdf_source in pending.items():
+            try:
+                outcomes[(journal, pdf_hash)] = _parse_one(pdf_source, journal)
+            except Exception as e:
+                logger.opt(exception=e).error(f"Exception found: {e}")
+                outcomes[(journal, pdf_hash)] = e
+
+    # Only keep the conversions of the files that are still uploaded
+    st.session_state["conversions"] = outcomes
+    return outcomes
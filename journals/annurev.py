@@ -6,8 +6,45 @@ import pandas as pd
 from log import log_traceback
 from section import *
 
+IN_PARANTHESES_CITATION_REGEX = r"\([&\w\s., ]+\s\d{3,4}\)"
+AND_PATTERN = r"\S+ & \S+ \(\d{3,4}\)"
+ONE_PATTERN = r"[A-Z]\S+ \(\d{3,4}\)"
+ET_AL_PATTERN = r"[A-Z][a-z] et al. \(\d{3,4}\)"
+# All four citation forms are matched in a single scan of the text
+IN_TEXT_CITATION_REGEX = re.compile(
+    f"{IN_PARANTHESES_CITATION_REGEX}|{AND_PATTERN}|{ONE_PATTERN}|{ET_AL_PATTERN}"
+)
+
+CITATION_NOISE_REGEX = re.compile(r"\(|\)|see also|’s")
+REFERENCE_REGEX = re.compile(r"[A-Z][A-Za-z, ]+[A-Z]{1,3}\. \d{4}\.")
+
+# Newlines become spaces and double quotes become single quotes in downloads
+DOWNLOAD_TRANSLATION_TABLE = str.maketrans({"\n": " ", '"': "'"})
+
+
+def iter_spans(page, rect):
+    """
+    Yields the text and font size of every text span on a page.
+
+    Image blocks are left out of the extraction, and the page's text
+    dictionary is released as soon as its spans have been consumed.
+
+    Args:
+        page (fitz.Page): The page to extract spans from.
+        rect (fitz.Rect): The area of the page to extract text from.
+
+    Yields:
+        tuple: The text and font size of a span.
+    """
+    page_dict = page.get_text(
+        "dict", clip=rect, flags=fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+    )
+    for block in page_dict["blocks"]:
+        for line in block.get("lines", ()):
+            for span in line["spans"]:
+                yield span["text"], span["size"]
+
 
-@log_traceback
 def get_sections(doc):
     """
     Generates the sections for the given document.
@@ -19,56 +56,49 @@ def get_sections(doc):
         list: The final sections of the document.
     """
 
-    main_section = Section("", 100)
-    prev_size = 100
+    # Font sizes are compared as integer hundredths of a point
+    main_section = Section("", 10000)
+    prev_size = 10000
     curr_section = main_section
 
-    for page in doc:
-        if page.number not in (doc[-1].number, doc[-2].number):
-            rect = fitz.Rect(
-                page.rect.x0 + 20,
-                page.rect.y0 + 20,
-                page.rect.x1 - 20,
-                page.rect.y1 - 30,
-            )
+    # The last two pages are never part of the article body
+    for page in doc.pages(0, max(doc.page_count - 2, 0)):
+        rect = fitz.Rect(
+            page.rect.x0 + 20,
+            page.rect.y0 + 20,
+            page.rect.x1 - 20,
+            page.rect.y1 - 30,
+        )
+
+        for text, size in iter_spans(page, rect):
+            cur_size = int(size * 100 + 0.5)
+
+            if text.strip() in (
+                "Abstract",
+                "Keywords",
+                "LITERATURE CITED",
+            ):
+                cur = Section(text, cur_size)
+                curr_section = main_section.children[-1].children[-1]
+                curr_section.add_child(cur)
+                cur.set_parent(curr_section)
+                curr_section = cur
+
+                prev_size = cur_size
 
-            blocks = page.get_text("dict", clip=rect)["blocks"]
-            for block in blocks:
-                if "lines" in block.keys():
-                    spans = block["lines"]
-                    for span in spans:
-                        data = span["spans"]
-                        for lines in data:
-                            cur_size = round(lines["size"], 2)
-
-                            if lines["text"].strip() in (
-                                "Abstract",
-                                "Keywords",
-                                "LITERATURE CITED",
-                            ):
-                                cur = Section(lines["text"], cur_size)
-                                curr_section = main_section.children[-1].children[-1]
-                                curr_section.add_child(cur)
-                                cur.set_parent(curr_section)
-                                curr_section = cur
-
-                                prev_size = round(lines["size"], 2)
-
-                            elif cur_size > prev_size:
-                                curr_section = curr_section.backtrack_add(
-                                    lines["text"], cur_size
-                                )
-                                prev_size = curr_section.size
-
-                            elif cur_size == prev_size:
-                                curr_section.extend(lines["text"])
-
-                            else:
-                                cur = Section(lines["text"], cur_size)
-                                curr_section.add_child(cur)
-                                cur.set_parent(curr_section)
-                                curr_section = cur
-                                prev_size = round(lines["size"], 2)
+            elif cur_size > prev_size:
+                curr_section = curr_section.backtrack_add(text, cur_size)
+                prev_size = curr_section.size
+
+            elif cur_size == prev_size:
+                curr_section.extend(text)
+
+            else:
+                cur = Section(text, cur_size)
+                curr_section.add_child(cur)
+                cur.set_parent(curr_section)
+                curr_section = cur
+                prev_size = cur_size
 
     final_sections = main_section.children[-1].children
 
@@ -78,7 +108,6 @@ def get_sections(doc):
         return final_sections[-1].children
 
 
-@log_traceback
 def preprocess_sections(sections):
     """
     Preprocess sections.
@@ -96,7 +125,6 @@ def preprocess_sections(sections):
     return sections
 
 
-@log_traceback
 def make_sections_dataframe(doc):
     """
     Generate a DataFrame containing the sections of a document.
@@ -113,14 +141,15 @@ def make_sections_dataframe(doc):
     content_nest = {}
 
     for section in sections:
-        content_nest[section.content] = [section.print_contents()]
+        content_nest[section.content] = section.print_contents()
 
-    sections_df = pd.DataFrame(content_nest, index=["text"]).T
+    sections_df = pd.DataFrame(
+        {"text": list(content_nest.values())}, index=list(content_nest)
+    )
     sections_df.name = doc.name
     return sections, sections_df
 
 
-@log_traceback
 def make_references_dataframe(sections, sections_df):
     """
     Generate a df of references from the given sections and sections_df.
@@ -135,9 +164,10 @@ def make_references_dataframe(sections, sections_df):
     references_dictionary = {}
     references_text = sections[sections.index("LITERATURE CITED")].print_contents()
     references_clean = text_preprocess_for_reference_matching(references_text)
+    year_index = {}
 
-    for location, text in zip(sections_df.index[:-1], sections_df.values[:-1]):
-        in_text_citations = get_in_text_citations(text.item())
+    for location, text in sections_df["text"].iloc[:-1].items():
+        in_text_citations = get_in_text_citations(text)
         cleaned_in_text_citations = clean_in_text_citations(in_text_citations)
         author_year_pairs = list(
             filter(
@@ -146,18 +176,25 @@ def make_references_dataframe(sections, sections_df):
             )
         )
         references_dictionary = find_citation_matches(
-            author_year_pairs, references_clean, references_dictionary, location
+            author_year_pairs,
+            references_clean,
+            references_dictionary,
+            location,
+            year_index,
         )
 
     references_df = pd.DataFrame(
-        {k: [",".join(v)] for k, v in references_dictionary.items()},
-        index=["section"],
-    ).T.reset_index(names="reference")
+        {
+            "reference": list(references_dictionary),
+            "section": [
+                ",".join(locations) for locations in references_dictionary.values()
+            ],
+        }
+    )
 
     return references_df
 
 
-@log_traceback
 def clean_in_text_citations(in_text_citations):
     """
     Cleans the in-text citations by removing unnecessary characters and splitting them into individual items.
@@ -172,14 +209,13 @@ def clean_in_text_citations(in_text_citations):
     return [
         item
         for group in [
-            re.sub(r"\(|\)|see also|’s", "", item).split(",")
+            CITATION_NOISE_REGEX.sub("", item).split(",")
             for item in in_text_citations
         ]
         for item in group
     ]
 
 
-@log_traceback
 def text_preprocess_for_reference_matching(references_text):
     """
     Preprocesses the given references text for reference matching.
@@ -190,25 +226,17 @@ def text_preprocess_for_reference_matching(references_text):
     Returns:
         list: A list of cleaned references.
     """
-    references_dirty = re.sub("\n", " ", references_text)
-    references = " ".join(references_dirty.split())
-    pattern = "[A-Z][A-Za-z, ]+[A-Z]{1,3}\. \d{4}\."
-    references_clean = re.findall(pattern, references)
-
-    for idx, ref in enumerate(references_clean):
-        if idx == len(references_clean) - 1:
-            # All the way to the end
-            references_clean[idx] = references[references.find(ref) :]
-        else:
-            next_ref = references_clean[idx + 1]
-            references_clean[idx] = references[
-                references.find(ref) : references.find(next_ref)
-            ]
+    # Splitting on whitespace also takes care of newlines
+    references = " ".join(references_text.split())
+    # Each reference runs from where its match starts to where the next one
+    # starts, or all the way to the end for the last one
+    starts = [match.start() for match in REFERENCE_REGEX.finditer(references)]
+    ends = starts[1:] + [len(references)]
+    references_clean = [references[start:end] for start, end in zip(starts, ends)]
 
     return references_clean
 
 
-@log_traceback
 def get_in_text_citations(text):
     """
     Extracts in-text citations from a given text.
@@ -219,14 +247,7 @@ def get_in_text_citations(text):
     Returns:
         List[str]: A list of in-text citations found in the text.
     """
-    IN_PARANTHESES_CITATION_REGEX = r"\([&\w\s., ]+\s\d{3,4}\)"
-    AND_PATTERN = "\S+ & \S+ \(\d{3,4}\)"
-    ONE_PATTERN = "[A-Z]\S+ \(\d{3,4}\)"
-    ET_AL_PATTERN = "[A-Z][a-z] et al. \(\d{3,4}\)"
-    IN_TEXT_CITATION_REGEX = (
-        f"{IN_PARANTHESES_CITATION_REGEX}|{AND_PATTERN}|{ONE_PATTERN}|{ET_AL_PATTERN}"
-    )
-    return re.findall(IN_TEXT_CITATION_REGEX, text)
+    return IN_TEXT_CITATION_REGEX.findall(text)
 
 
 def process_citations(citation: str):
@@ -269,8 +290,9 @@ def process_citations(citation: str):
             return ([author.strip()], year.strip())
 
 
-@log_traceback
-def find_citation_matches(author_year_pairs, full_references, data, location):
+def find_citation_matches(
+    author_year_pairs, full_references, data, location, year_index=None
+):
     """
     Find citation matches in the given list of author-year pairs and full references.
 
@@ -279,26 +301,31 @@ def find_citation_matches(author_year_pairs, full_references, data, location):
     - full_references (list): A list of full references to search in.
     - data (dict): A dictionary to store the citation matches.
     - location (str): The location to associate with the citation matches.
+    - year_index (dict, optional): Maps a year to the references that contain it.
+      It is filled in as new years are seen, so passing the same dictionary for
+      every section only scans the references once per distinct year.
 
     Returns:
     - data (dict): The updated dictionary with the citation matches.
     """
+    if year_index is None:
+        year_index = {}
     for author_year_pair in author_year_pairs:
         authors, year = author_year_pair
-        for reference in full_references:
+        if year not in year_index:
+            year_index[year] = [
+                reference for reference in full_references if year in reference
+            ]
+        for reference in year_index[year]:
             match = True
-            if year in reference:
-                for author in authors:
-                    if author not in reference:
-                        match = False
-                if match:
-                    dict_value = data.get(reference, [])
-                    if dict_value == []:
-                        data[reference] = []
-                    if location not in dict_value:
-                        data[reference] = data.get(reference, []) + [location]
-            else:
-                continue
+            for author in authors:
+                if author not in reference:
+                    match = False
+                    break
+            if match:
+                locations = data.setdefault(reference, [])
+                if location not in locations:
+                    locations.append(location)
     return data
 
 
@@ -324,7 +351,8 @@ def convert_pdf_to_dataframes(doc):
 def sanitize_dataframe_for_download(df):
     """
     Sanitizes a pandas DataFrame for download by replacing newline characters and
-    double quotes in string columns.
+    double quotes in string columns. Both replacements are applied in a single
+    pass over each column.
 
     Parameters:
         df (pandas.DataFrame): The DataFrame to be sanitized.
@@ -332,10 +360,10 @@ def sanitize_dataframe_for_download(df):
     Returns:
         pandas.DataFrame: The sanitized DataFrame.
     """
-    for col in df.columns:
-        if df[col].dtype == "object":
-            try:
-                df[col] = df[col].str.replace("\n", " ").str.replace('"', "'")
-            except AttributeError:
-                continue
+    for col in df.select_dtypes(include=["object", "string"]).columns:
+        try:
+            df[col] = df[col].str.translate(DOWNLOAD_TRANSLATION_TABLE)
+        except AttributeError:
+            # Object column without any string values
+            continue
     return df
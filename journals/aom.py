@@ -1,4 +1,5 @@
 import re
+from collections import defaultdict
 
 import pandas as pd
 
@@ -6,6 +7,19 @@ from log import log_traceback
 
 AOM_HEADER_SIZE = (9.96, 10.0)
 
+IN_PARANTHESES_CITATION_REGEX = r"\([&\w\s.,\-; ]+\s\d{3,4}\)"
+AND_PATTERN = r"\S+ & \S+ \(\d{3,4}\)"
+ONE_PATTERN = r"[A-Z]\S+ \(\d{3,4}\)"
+ET_AL_PATTERN = r"[A-Z][a-z] et al. \(\d{3,4}\)"
+# All four citation forms are matched in a single scan of the text
+IN_TEXT_CITATION_REGEX = re.compile(
+    f"{IN_PARANTHESES_CITATION_REGEX}|{AND_PATTERN}|{ONE_PATTERN}|{ET_AL_PATTERN}"
+)
+
+REFERENCE_REGEX = re.compile(
+    r"[A-Z][a-z]+, [A-Z]*[A-Za-z,\-’&.ˇ ]*[A-Z]{1,3}\.\s\d{4}\."
+)
+
 
 @log_traceback
 def get_pre_sections(doc):
@@ -17,56 +31,67 @@ def get_pre_sections(doc):
     Returns:
         tuple: A tuple containing three elements:
             - list: A list of text spans in the document.
-            - dict: A dictionary of text spans on the first page, grouped by font size.
-            - dict: A dictionary of text spans on the remaining pages, grouped by font size.
+            - dict: A dictionary of text spans on the first page, grouped by font size
+                and sorted by descending size.
+            - dict: A dictionary of text spans on all pages, grouped by font size.
     """
-    first_page_fonts = {}
-    rest_fonts = {}
-    seqs = []
-    prev_size, prev_font = 0, 0
+    # Pull the spans out of PyMuPDF's nested dict into flat parallel lists
+    # first, so the grouping below does no dict lookups into its structure
+    sizes, fonts, texts, page_numbers = [], [], [], []
     for page in doc:
-        d = page.get_text("dict")
-        blocks = d["blocks"]
-        for block in blocks:
-            if "lines" in block.keys():
-                spans = block["lines"]
-                for span in spans:
-                    data = span["spans"]
-                    for lines in data:
-                        cur_size = round(lines["size"], 2)
-                        cur_font = lines["font"].split("+")[0]
-
-                        key = (cur_font, cur_size)
-
-                        if cur_size == prev_size and cur_font == prev_font:
-                            latest_item = rest_fonts[key][-1]
-
-                            if page.number == 0:
-                                first_page_fonts[key][-1] = (
-                                    latest_item + " " + lines["text"]
-                                )
-
-                            rest_fonts[key][-1] = latest_item + " " + lines["text"]
-                            seqs[-1] = seqs[-1] + " " + lines["text"]
-
-                        else:
-                            if page.number == 0:
-                                first_page_fonts[key] = first_page_fonts.get(
-                                    key, []
-                                ) + [lines["text"]]
-                            rest_fonts[key] = rest_fonts.get(key, []) + [lines["text"]]
-                            seqs.append(lines["text"])
-
-                        prev_size = cur_size
-                        prev_font = cur_font
+        for block in page.get_text("dict")["blocks"]:
+            for line in block.get("lines", ()):
+                for span in line["spans"]:
+                    font = span["font"]
+                    sizes.append(round(span["size"], 2))
+                    # Drop the subset prefix ("ABCDEF+Font") only when present
+                    fonts.append(font.partition("+")[0] if "+" in font else font)
+                    texts.append(span["text"])
+                    page_numbers.append(page.number)
+
+    first_page_fonts = defaultdict(list)
+    rest_fonts = defaultdict(list)
+    seqs = []
+    prev_font, prev_size = 0, 0
+    key = None
+    for cur_size, cur_font, text, page_number in zip(
+        sizes, fonts, texts, page_numbers
+    ):
+        # Runs are kept as lists of fragments and joined once
+        # at the end, instead of growing a string per span
+        if cur_size == prev_size and cur_font == prev_font:
+            # Same run, so the previous span's key is reused as is
+            if page_number == 0:
+                first_page_fonts[key][-1].append(text)
+
+            rest_fonts[key][-1].append(text)
+            seqs[-1].append(text)
+
+        else:
+            key = (cur_font, cur_size)
+            if page_number == 0:
+                first_page_fonts[key].append([text])
+            rest_fonts[key].append([text])
+            seqs.append([text])
+
+            prev_font, prev_size = key
+
+    seqs = [" ".join(fragments) for fragments in seqs]
+    first_page_fonts = {
+        key: [" ".join(fragments) for fragments in runs]
+        for key, runs in first_page_fonts.items()
+    }
+    rest_fonts = {
+        key: [" ".join(fragments) for fragments in runs]
+        for key, runs in rest_fonts.items()
+    }
 
     sorted_first_page_fonts = dict(
         sorted(first_page_fonts.items(), key=lambda x: x[0][1], reverse=True)
     )
-    sorted_rest_fonts = dict(
-        sorted(rest_fonts.items(), key=lambda x: x[0][1], reverse=True)
-    )
-    return seqs, sorted_first_page_fonts, sorted_rest_fonts
+    # The rest of the document is only searched for one size at a time in
+    # get_headers, which finds the same first match without a sort
+    return seqs, sorted_first_page_fonts, rest_fonts
 
 
 @log_traceback
@@ -99,17 +124,17 @@ def get_abstract(first_page_fonts):
     Returns:
         dict: A dictionary containing the abstract text under the key 'Abstract'.
     """
-    first_page_fonts = dict(reversed(first_page_fonts.items()))
-    dict_items = first_page_fonts.items()
+    # Walked in reverse, sizes ascend, so the first header-sized font found is
+    # also the first one in AOM_HEADER_SIZE order. The item before the very
+    # first font wraps around to the last one.
+    prev_blocks = next(iter(first_page_fonts.values()), None)
+    for (font, font_size), blocks in reversed(first_page_fonts.items()):
+        # Get item right before authors
+        if font_size in AOM_HEADER_SIZE:
+            return {"Abstract": prev_blocks[0]}
+        prev_blocks = blocks
 
-    # Try first header, then try second
-    for header in AOM_HEADER_SIZE:
-        for idx, ((font, font_size), blocks) in enumerate(dict_items):
-            # Get item right before authors
-            if font_size == header:
-                return {"Abstract": list(dict_items)[idx - 1][1][0]}
-
-    return first_page_fonts
+    return dict(reversed(first_page_fonts.items()))
 
 
 @log_traceback
@@ -124,15 +149,24 @@ def get_text_nest(seqs, starting_text_nest, pdf_headers):
     Returns:
         dict: A dictionary containing the grouped text sequences.
     """
+    pdf_headers = frozenset(pdf_headers)
+    # Each section's text is collected as a list of fragments and joined once
+    # at the end, instead of growing a string per sequence
+    text_fragments = {}
     cur_header = "Intro"
     for sequence in seqs:
         if sequence in pdf_headers:
             starting_text_nest[sequence] = ""
+            text_fragments[sequence] = [""]
             cur_header = sequence
         else:
-            starting_text_nest[cur_header] = (
-                starting_text_nest.get(cur_header, "") + " " + sequence
-            )
+            if cur_header not in text_fragments:
+                starting_text_nest.setdefault(cur_header, "")
+                text_fragments[cur_header] = [starting_text_nest[cur_header]]
+            text_fragments[cur_header].append(sequence)
+
+    for header, fragments in text_fragments.items():
+        starting_text_nest[header] = " ".join(fragments)
     return starting_text_nest
 
 
@@ -172,7 +206,9 @@ def make_sections_dataframe(doc):
 
 
 @log_traceback
-def find_citation_matches(author_year_pairs, full_references, data, location):
+def find_citation_matches(
+    author_year_pairs, full_references, data, location, year_index=None
+):
     """Finds citation matches in the references text.
 
     Args:
@@ -180,26 +216,31 @@ def find_citation_matches(author_year_pairs, full_references, data, location):
         full_references (list): List of full references extracted from the text.
         data (dict): A dictionary to store the matched citations.
         location (str): The section location where the citations were found.
+        year_index (dict, optional): Maps a year to the references containing it.
+            It is filled in as new years are seen, so sharing it across sections
+            scans the references only once per distinct year.
 
     Returns:
         dict: Updated data dictionary with matched citations.
     """
+    if year_index is None:
+        year_index = {}
     for author_year_pair in author_year_pairs:
         authors, year = author_year_pair
-        for reference in full_references:
+        if year not in year_index:
+            year_index[year] = [
+                reference for reference in full_references if year in reference
+            ]
+        for reference in year_index[year]:
             match = True
-            if year in reference:
-                for author in authors:
-                    if author not in reference:
-                        match = False
-                if match:
-                    dict_value = data.get(reference, [])
-                    if dict_value == []:
-                        data[reference] = []
-                    if location not in dict_value:
-                        data[reference] = data.get(reference, []) + [location]
-            else:
-                continue
+            for author in authors:
+                if author not in reference:
+                    match = False
+                    break
+            if match:
+                locations = data.setdefault(reference, [])
+                if location not in locations:
+                    locations.append(location)
     return data
 
 
@@ -216,47 +257,47 @@ def process_citations(citation_group: str):
     results = []
     citations = citation_group.split(";")
     for citation in citations:
-        try:
-            # case 1: &
-            if "&" in citation:
-                tokens = citation.split(",")
-                year = tokens[-1]
-                names = ",".join(tokens[:-1])
-                names = names.replace("&", ",")
-                names_split = names.split(",")
-                results.append(
-                    (
-                        [
-                            name.strip()
-                            for name in names_split
-                            if name.strip() not in ("", "e.g.")
-                        ],
-                        year.strip(),
-                    )
+        tokens = citation.split(",")
+
+        # case 1: &
+        if "&" in citation:
+            names = ",".join(tokens[:-1])
+            names = names.replace("&", ",")
+            names_split = names.split(",")
+            results.append(
+                (
+                    [
+                        name
+                        for name in map(str.strip, names_split)
+                        if name and name != "e.g."
+                    ],
+                    tokens[-1].strip(),
                 )
+            )
 
-            # case 2: et al
-            if "et al." in citation:
-                citation = citation.replace("et al.", "")
-                tokens = citation.split(",")
-                results.append(
-                    (
-                        [token.strip() for token in tokens[:-1] if token.strip() != ""],
-                        tokens[-1].strip(),
-                    )
+        # case 2: et al
+        elif "et al." in citation:
+            tokens = citation.replace("et al.", "").split(",")
+            results.append(
+                (
+                    [token for token in map(str.strip, tokens[:-1]) if token],
+                    tokens[-1].strip(),
                 )
+            )
 
-            # case 3: 1 author
+        # case 3: 1 author
+        elif "(" in citation:
+            author_and_year = citation.split()
+            if len(author_and_year) == 2:
+                author, year = author_and_year
+                results.append(([author], year[1:-1]))
             else:
-                if "(" in citation:
-                    author, year = citation.split()
-                    results.append(([author], year[1:-1]))
-                else:
-                    citation_split = citation.split(",")
-                    results.append(([citation_split[-2]], citation_split[-1].strip()))
-
-        except Exception as e:
-            # If any error occurs during citation processing, add an empty entry.
+                # Not an "Author (Year)" citation, add an empty entry
+                results.append(([""], ""))
+        elif len(tokens) >= 2:
+            results.append(([tokens[-2]], tokens[-1].strip()))
+        else:
+            # Not an "Author, Year" citation, add an empty entry
             results.append(([""], ""))
 
         return results
@@ -272,20 +313,13 @@ def text_preprocess_for_reference_matching(references_text):
     Returns:
         list: A list of cleaned references extracted from the text.
     """
-    references_dirty = re.sub("\n", " ", references_text)
-    references = " ".join(references_dirty.split())
-    pattern = "[A-Z][a-z]+, [A-Z]*[A-Za-z,\-’&.ˇ ]*[A-Z]{1,3}\.\s\d{4}\."
-    references_clean = re.findall(pattern, references)
-
-    for idx, ref in enumerate(references_clean):
-        if idx == len(references_clean) - 1:
-            # All the way to the end
-            references_clean[idx] = references[references.find(ref) :]
-        else:
-            next_ref = references_clean[idx + 1]
-            references_clean[idx] = references[
-                references.find(ref) : references.find(next_ref)
-            ]
+    # Splitting on whitespace also takes care of newlines
+    references = " ".join(references_text.split())
+    # Each reference runs from where its match starts to where the next one
+    # starts, or all the way to the end for the last one
+    starts = [match.start() for match in REFERENCE_REGEX.finditer(references)]
+    ends = starts[1:] + [len(references)]
+    references_clean = [references[start:end] for start, end in zip(starts, ends)]
 
     return references_clean
 
@@ -311,6 +345,7 @@ def make_references_dataframe(text_nest, sections_df):
         references_clean = text_preprocess_for_reference_matching(
             list(text_nest.values())[-1]
         )
+    year_index = {}
 
     for location, text in zip(sections_df.index, sections_df.values):
         if location != "REFERENCES":
@@ -329,13 +364,21 @@ def make_references_dataframe(text_nest, sections_df):
                 item for group in author_year_pairs_nested for item in group
             ]
             references_dictionary = find_citation_matches(
-                author_year_pairs, references_clean, references_dictionary, location
+                author_year_pairs,
+                references_clean,
+                references_dictionary,
+                location,
+                year_index,
             )
 
     references_df = pd.DataFrame(
-        {k: [",".join(v)] for k, v in references_dictionary.items()},
-        index=["section"],
-    ).T.reset_index(names="reference")
+        {
+            "reference": list(references_dictionary),
+            "section": [
+                ",".join(locations) for locations in references_dictionary.values()
+            ],
+        }
+    )
 
     return references_df
 
@@ -350,14 +393,7 @@ def get_in_text_citations(text):
     Returns:
         list: A list of in-text citations found in the text.
     """
-    IN_PARANTHESES_CITATION_REGEX = r"\([&\w\s.,\-; ]+\s\d{3,4}\)"
-    AND_PATTERN = "\S+ & \S+ \(\d{3,4}\)"
-    ONE_PATTERN = "[A-Z]\S+ \(\d{3,4}\)"
-    ET_AL_PATTERN = "[A-Z][a-z] et al. \(\d{3,4}\)"
-    IN_TEXT_CITATION_REGEX = (
-        f"{IN_PARANTHESES_CITATION_REGEX}|{AND_PATTERN}|{ONE_PATTERN}|{ET_AL_PATTERN}"
-    )
-    return re.findall(IN_TEXT_CITATION_REGEX, text)
+    return IN_TEXT_CITATION_REGEX.findall(text)
 
 
 @log_traceback
@@ -1,6 +1,9 @@
+import functools
 import itertools
 import re
+from collections import defaultdict
 
+import fitz
 import pandas as pd
 
 from log import log_traceback
@@ -8,28 +11,24 @@ from log import log_traceback
 ABSTRACT_KEY = ("AdvPSA35F", 10.0)
 HEADERS_KEY = ("AdvP2A83", 10.0)
 
+IN_PARANTHESES_CITATION_REGEX = r"\([&\w\s.,\-; ]+\s\d{3,4}\)"
+AND_PATTERN = r"\S+ and \S+ \(\d{3,4}\)"
+ONE_PATTERN = r"[A-Z]\S+ \(\d{3,4}\)"
+ET_AL_PATTERN = r"[A-Z][a-z] et al. \(\d{3,4}\)"
+# All four citation forms are matched in a single scan of the text
+IN_TEXT_CITATION_REGEX = re.compile(
+    f"{IN_PARANTHESES_CITATION_REGEX}|{AND_PATTERN}|{ONE_PATTERN}|{ET_AL_PATTERN}"
+)
 
-@log_traceback
-def make_sections_dataframe(doc):
-    """
-    Generate a dataframe with sections of text from a document.
+REFERENCE_REGEX = re.compile(r"[A-Z][A-Za-z,\-’.ˇ() ]+ \d{4} ")
 
-    Parameters:
-    - doc: The document from which to extract sections of text.
-
-    Returns:
-    - text_nest: A nested list of sections of text.
-    - sections_df: A dataframe with the sections of text, indexed by "text"
-                   and with the document name as the column name.
-    """
-    text_nest = get_sections(doc)
-    sections_df = pd.DataFrame(text_nest, index=["text"]).T
-    sections_df.columns = [doc.name]
-    return text_nest, sections_df
+UPPERCASE_REGEX = re.compile(r"[A-Z]")
 
 
 @log_traceback
-def find_citation_matches(author_year_pairs, full_references, data, location):
+def find_citation_matches(
+    author_year_pairs, full_references, data, location, year_index=None
+):
     """
     Find citation matches based on author-year pairs, full references, data, and location.
 
@@ -38,77 +37,90 @@ def find_citation_matches(author_year_pairs, full_references, data, location):
         - full_references (list): A list of full references.
         - data (dict): A dictionary containing reference data.
         - location (str): The location to match.
+        - year_index (dict, optional): Maps a year to the references containing it.
+          It is filled in as new years are seen, so sharing it across sections
+          scans the references only once per distinct year.
 
     Returns:
         - dict: The updated dictionary containing matched references and locations.
     """
+    if year_index is None:
+        year_index = {}
     for author_year_pair in author_year_pairs:
         authors, year = author_year_pair
-        for reference in full_references:
+        if year not in year_index:
+            year_index[year] = [
+                reference for reference in full_references if year in reference
+            ]
+        for reference in year_index[year]:
             match = True
-            if year in reference:
-                for author in authors:
-                    if author not in reference:
-                        match = False
-                if match:
-                    dict_value = data.get(reference, [])
-                    if dict_value == []:
-                        data[reference] = []
-                    if location not in dict_value:
-                        data[reference] = data.get(reference, []) + [location]
-            else:
-                continue
+            for author in authors:
+                if author not in reference:
+                    match = False
+                    break
+            if match:
+                locations = data.setdefault(reference, [])
+                if location not in locations:
+                    locations.append(location)
     return data
 
 
 @log_traceback
+@functools.lru_cache(maxsize=4096)
 def process_citations(citation_group: str):
     """
-    Processes a citation group and returns a list of parsed citations.
+    Processes a citation group and returns a tuple of parsed citations.
+
+    The same citation group is often cited in several sections, so results are
+    cached per citation group string. They are returned as tuples so that the
+    cached values cannot be changed by the caller.
 
     Args:
         citation_group (str): A string containing multiple citations separated by semicolons.
 
     Returns:
-        list: A list of tuples representing the parsed citations. Each tuple contains two elements:
-        - names (list): A list of author names.
+        tuple: A tuple of tuples representing the parsed citations. Each tuple contains two elements:
+        - names (tuple): A tuple of author names.
         - year (str): The publication year of the citation.
     """
     citations = citation_group.split(";")
     results = []
 
     for citation in citations:
-        try:
-            # case 1: multiple authors
-            if " and " in citation:
-                names, year = citation.split(",")[:-1], citation.split(",")[-1]
-                names = [
-                    name.strip() for name in names if name.strip() not in ("", "e.g.")
-                ]
-                names = [name.replace(" and ", ",") for name in names]
-                results.append((names, year.strip()))
-
-            # case 2: et al
-            elif "et al." in citation:
-                citation = citation.replace("et al.", "")
-                names, year = citation.split(",")[:-1], citation.split(",")[-1]
-                names = [name.strip() for name in names if name.strip() != ""]
-                results.append((names, year.strip()))
-
-            # case 3: 1 author
-            else:
-                if "(" in citation:
-                    author, year = citation.split()
+        # case 1: multiple authors
+        if " and " in citation:
+            names, year = citation.split(",")[:-1], citation.split(",")[-1]
+            names = [
+                name.strip() for name in names if name.strip() not in ("", "e.g.")
+            ]
+            names = [name.replace(" and ", ",") for name in names]
+            results.append((names, year.strip()))
+
+        # case 2: et al
+        elif "et al." in citation:
+            citation = citation.replace("et al.", "")
+            names, year = citation.split(",")[:-1], citation.split(",")[-1]
+            names = [name.strip() for name in names if name.strip() != ""]
+            results.append((names, year.strip()))
+
+        # case 3: 1 author
+        else:
+            # Citations that don't fit the expected shape get an empty entry
+            if "(" in citation:
+                author_and_year = citation.split()
+                if len(author_and_year) == 2:
+                    author, year = author_and_year
                     results.append(([author], year[1:-1]))
                 else:
-                    names, year = citation.split(
-                        ",")[:-1], citation.split(",")[-1]
+                    results.append(([""], ""))
+            else:
+                names = citation.split(",")[:-1]
+                if len(names) >= 2:
                     results.append(([names[-2].strip()], names[-1].strip()))
+                else:
+                    results.append(([""], ""))
 
-        except:
-            results.append(([""], ""))
-
-    return results
+    return tuple((tuple(names), year) for names, year in results)
 
 
 @log_traceback
@@ -122,14 +134,14 @@ def remove_prefix(citation):
     Returns:
         str: The citation string without the prefix.
     """
-    is_parantheses = False
-    for idx, char in enumerate(citation):
-        if char == "." and citation[idx - 1].islower() and not is_parantheses:
+    # Only the periods are visited. A period is inside parentheses when the
+    # last "(" before it comes after the last ")" before it
+    idx = citation.find(".")
+    while idx != -1:
+        is_parantheses = citation.rfind("(", 0, idx) > citation.rfind(")", 0, idx)
+        if citation[idx - 1].islower() and not is_parantheses:
             return citation[idx + 2:]
-        if char == "(":
-            is_parantheses = True
-        if char == ")":
-            is_parantheses = False
+        idx = citation.find(".", idx + 1)
 
     return citation
 
@@ -146,21 +158,16 @@ def text_preprocess_for_reference_matching(references_text):
         list: A list of cleaned references.
 
     """
-    references_dirty = re.sub("\n", " ", references_text)
-    references = " ".join(references_dirty.split())
-    pattern = "[A-Z][A-Za-z,\-’.ˇ() ]+ \d{4} "
-    references_clean = list(
-        map(remove_prefix, re.findall(pattern, references)))
-
-    for idx, ref in enumerate(references_clean):
-        if idx == len(references_clean) - 1:
-            # All the way to the end
-            references_clean[idx] = references[references.find(ref):]
-        else:
-            next_ref = references_clean[idx + 1]
-            references_clean[idx] = references[
-                references.find(ref): references.find(next_ref)
-            ]
+    # Splitting on whitespace also takes care of newlines
+    references = " ".join(references_text.split())
+    # Each reference starts where its match starts once the prefix is removed,
+    # and runs to where the next one starts, or all the way to the end
+    starts = [
+        match.end() - len(remove_prefix(match.group()))
+        for match in REFERENCE_REGEX.finditer(references)
+    ]
+    ends = starts[1:] + [len(references)]
+    references_clean = [references[start:end] for start, end in zip(starts, ends)]
 
     return references_clean
 
@@ -181,8 +188,9 @@ def make_references_dataframe(text_nest, sections_df):
     references_dictionary = {}
     references_clean = text_preprocess_for_reference_matching(
         text_nest["REFERENCES"])
-    for location, text in zip(sections_df.index, sections_df.values):
-        in_text_citations = get_in_text_citations(text.item())
+    year_index = {}
+    for location, text in sections_df["text"].items():
+        in_text_citations = get_in_text_citations(text)
         cleaned_in_text_citations = [
             citation if citation[0] != "(" else citation[1:-1]
             for citation in in_text_citations
@@ -197,13 +205,21 @@ def make_references_dataframe(text_nest, sections_df):
         )
 
         references_dictionary = find_citation_matches(
-            author_year_pairs, references_clean, references_dictionary, location
+            author_year_pairs,
+            references_clean,
+            references_dictionary,
+            location,
+            year_index,
         )
 
     references_df = pd.DataFrame(
-        {k: [",".join(v)] for k, v in references_dictionary.items()},
-        index=["section"],
-    ).T.reset_index(names="reference")
+        {
+            "reference": list(references_dictionary),
+            "section": [
+                ",".join(locations) for locations in references_dictionary.values()
+            ],
+        }
+    )
 
     return references_df
 
@@ -228,14 +244,7 @@ def get_in_text_citations(text):
     Returns:
         List[str]: A list of in-text citations found in the text.
     """
-    IN_PARANTHESES_CITATION_REGEX = r"\([&\w\s.,\-; ]+\s\d{3,4}\)"
-    AND_PATTERN = "\S+ and \S+ \(\d{3,4}\)"
-    ONE_PATTERN = "[A-Z]\S+ \(\d{3,4}\)"
-    ET_AL_PATTERN = "[A-Z][a-z] et al. \(\d{3,4}\)"
-    IN_TEXT_CITATION_REGEX = (
-        f"{IN_PARANTHESES_CITATION_REGEX}|{AND_PATTERN}|{ONE_PATTERN}|{ET_AL_PATTERN}"
-    )
-    return re.findall(IN_TEXT_CITATION_REGEX, text)
+    return IN_TEXT_CITATION_REGEX.findall(text)
 
 
 @log_traceback
@@ -266,59 +275,61 @@ def structure_doc_by_size_and_font(doc):
     Returns:
         tuple: A tuple containing two elements:
             - seqs (list): A list of sequences of text extracted from the document.
-            - sorted_rest_fonts (list): A list of tuples containing font and size as keys and the corresponding
-              extracted text as values. The list is sorted in descending order based on the size of the font.
+            - fonts (dict): A dictionary with (font, size) tuples as keys and the corresponding
+              extracted text as values.
     """
-    fonts = {}
-    seqs = []
-    prev_size, prev_font = 0, 0
+    # Pull the spans out of PyMuPDF's nested dict into flat parallel lists
+    # first, so the grouping below does no dict lookups into its structure.
+    # Image blocks are never used, so they are left out of the extraction.
+    flags = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+    sizes, font_names, texts = [], [], []
     for page in doc:
-        blocks = page.get_text("dict")["blocks"]
-        for block in blocks:
-            if "lines" in block:
-                spans = block["lines"]
-                for span in spans:
-                    data = span["spans"]
-                    for lines in data:
-                        cur_size = round(lines["size"], 2)
-                        cur_font = lines["font"].split("+")[0]
-
-                        key = (cur_font, cur_size)
-
-                        if cur_size == prev_size and cur_font == prev_font:
-                            latest_item = fonts[key][-1]
-                            fonts[key][-1] = latest_item + " " + lines["text"]
-                            seqs[-1] = seqs[-1] + " " + lines["text"]
+        for block in page.get_text("dict", flags=flags)["blocks"]:
+            for line in block.get("lines", ()):
+                for span in line["spans"]:
+                    font = span["font"]
+                    sizes.append(round(span["size"], 2))
+                    # Drop the subset prefix ("ABCDEF+Font") only when present
+                    font_names.append(font.partition("+")[0] if "+" in font else font)
+                    texts.append(span["text"])
+
+    # Runs of spans with the same font and size are kept as lists of fragments
+    # and joined once at the end. Each font only records the positions of its
+    # runs in seqs, since both hold the same text.
+    fonts = defaultdict(list)
+    seqs = []
+    prev_font, prev_size = 0, 0
+    for cur_size, cur_font, text in zip(sizes, font_names, texts):
+        if cur_size == prev_size and cur_font == prev_font:
+            seqs[-1].append(text)
 
-                        else:
-                            fonts[key] = fonts.get(key, []) + [lines["text"]]
-                            seqs.append(lines["text"])
+        else:
+            key = (cur_font, cur_size)
+            fonts[key].append(len(seqs))
+            seqs.append([text])
 
-                        prev_size = cur_size
-                        prev_font = cur_font
+            prev_font, prev_size = key
 
-    sorted_fonts = sorted(fonts.items(), key=lambda x: x[0][1], reverse=True)
-    return seqs, sorted_fonts
+    seqs = [" ".join(fragments) for fragments in seqs]
+    fonts = {
+        key: [seqs[idx] for idx in run_indices] for key, run_indices in fonts.items()
+    }
+    return seqs, fonts
 
 
 @log_traceback
 def get_headers(fonts):
     """
-    Get the headers from a list of fonts.
+    Get the headers from a dictionary of fonts.
 
     Parameters:
-    - fonts (list): A list of fonts.
+    - fonts (dict): A dictionary of text grouped by (font, size).
 
     Returns:
     - list: The headers extracted from the fonts.
     """
-    first_part = []
-    second_part = []
-    for key, val in fonts:
-        if key == ABSTRACT_KEY:
-            first_part = val
-        if key == HEADERS_KEY:
-            second_part = val
+    first_part = fonts.get(ABSTRACT_KEY, [])
+    second_part = fonts.get(HEADERS_KEY, [])
     return first_part[:2] + second_part + first_part[2:]
 
 
@@ -334,6 +345,12 @@ def find_earliest_uppercase_index(s):
     - int: The index of the earliest uppercase character in the string,
            or the length of the string if no uppercase character is found.
     """
+    # ASCII text (the usual case) is searched by the regex engine; anything
+    # else falls back to the per-character check, which also treats caseless
+    # letters as uppercase
+    if s.isascii():
+        match = UPPERCASE_REGEX.search(s)
+        return match.start() if match else len(s)
     for i, char in enumerate(s):
         if char.isalpha() and char.upper() == char:
             return i
@@ -353,24 +370,39 @@ def get_text_nest(seqs, starting_text_nest, pdf_headers):
     Returns:
         dict: The updated text nest.
     """
+    pdf_headers = frozenset(pdf_headers)
+    # Each section's text is collected as a list of fragments and joined once
+    # at the end, instead of growing a string per sequence
+    text_fragments = {}
     cur_header = "Other"
-    for sequence in seqs[1:]:
+    # Only recomputed when the current header changes
+    is_keyword_header = False
+    for sequence in itertools.islice(seqs, 1, None):
         if sequence in pdf_headers:
             starting_text_nest[sequence] = ""
+            text_fragments[sequence] = [""]
             cur_header = sequence
+            is_keyword_header = cur_header.startswith("Keyword")
         else:
-            if cur_header.startswith("Keyword"):
+            if cur_header not in text_fragments:
+                starting_text_nest.setdefault(cur_header, "")
+                text_fragments[cur_header] = [starting_text_nest[cur_header]]
+            if is_keyword_header:
                 earliest_idx = find_earliest_uppercase_index(sequence)
                 keyword_part = sequence[:earliest_idx]
                 intro_part = sequence[earliest_idx:]
-                starting_text_nest[cur_header] = starting_text_nest.get(
-                    cur_header, "") + " " + keyword_part
+                text_fragments[cur_header].append(keyword_part)
                 cur_header = "Introduction"
-                starting_text_nest[cur_header] += " " + intro_part
+                is_keyword_header = False
+                if cur_header not in text_fragments:
+                    # The introduction must already be in the text nest
+                    text_fragments[cur_header] = [starting_text_nest[cur_header]]
+                text_fragments[cur_header].append(intro_part)
             else:
-                starting_text_nest[cur_header] = starting_text_nest.get(
-                    cur_header, "") + " " + sequence
+                text_fragments[cur_header].append(sequence)
 
+    for header, fragments in text_fragments.items():
+        starting_text_nest[header] = " ".join(fragments)
     return starting_text_nest
 
 
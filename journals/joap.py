@@ -1,3 +1,7 @@
+import functools
+import itertools
+
+import fitz
 import pandas as pd
 import regex as re
 
@@ -5,6 +9,20 @@ from log import log_traceback
 
 HEADER_KEY = ("Times-Bold", 10.0)
 
+IN_PARANTHESES_CITATION_REGEX = r"\([&\w\.\s,\-; ]+\s\d{3,4}(?::\s\d{1,4})?\s\)"
+AND_PATTERN = r"\S+ and \S+ \(\d{3,4}\)"
+ONE_PATTERN = r"[A-Z]\S+ \(\d{3,4}\)"
+ET_AL_PATTERN = r"[A-Z][a-z] et al. \(\d{3,4}\)"
+# All four citation forms are matched in a single scan of the text
+IN_TEXT_CITATION_REGEX = re.compile(
+    f"{IN_PARANTHESES_CITATION_REGEX}|{AND_PATTERN}|{ONE_PATTERN}|{ET_AL_PATTERN}"
+)
+YEAR_IN_PARANTHESES_REGEX = re.compile(r" \((\d{4})\)")
+
+REFERENCE_REGEX = re.compile(
+    r"(?:[\p{L}][\p{L}\s]+,(?:(?:\s|\-)[A-Z]\.){1,3}(?:,(?: . . .)?\s(?:&\s?)?)?)+ \(\d{4}\)"
+)
+
 
 @log_traceback
 def structure_doc_by_size_and_font(doc):
@@ -24,35 +42,47 @@ def structure_doc_by_size_and_font(doc):
     """
     rest_fonts = {}
     seqs = []
+    font_names = {}
     prev_size, prev_font = 0, 0
 
     for page in doc:
-        blocks = page.get_text("dict")["blocks"]
-        for block in blocks:
-            if "lines" in block.keys():
-                spans = block["lines"]
-                for span in spans:
-                    data = span["spans"]
-                    for lines in data:
-                        cur_size = round(lines["size"], 2)
-                        cur_font = lines["font"].split("+")[0]
-
-                        key = (cur_font, cur_size)
-
-                        if cur_size == prev_size and cur_font == prev_font:
-                            latest_item = rest_fonts[key][-1]
+        # Image blocks carry no text, so PyMuPDF is told to leave them out
+        blocks = page.get_text(
+            "dict", flags=fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+        )["blocks"]
+        spans = itertools.chain.from_iterable(
+            line["spans"] for block in blocks for line in block.get("lines", ())
+        )
+        for lines in spans:
+            cur_size = round(lines["size"], 2)
+            # A document only uses a handful of fonts, so each
+            # font name is stripped of its subset prefix once
+            raw_font = lines["font"]
+            cur_font = font_names.get(raw_font)
+            if cur_font is None:
+                cur_font = raw_font.partition("+")[0]
+                font_names[raw_font] = cur_font
+
+            key = (cur_font, cur_size)
+
+            # Runs are kept as lists of fragments and joined once
+            # at the end, instead of growing a string per span
+            if cur_size == prev_size and cur_font == prev_font:
+                rest_fonts[key][-1].append(lines["text"])
+                seqs[-1].append(lines["text"])
 
-                            rest_fonts[key][-1] = latest_item + \
-                                " " + lines["text"]
-                            seqs[-1] = seqs[-1] + " " + lines["text"]
+            else:
+                rest_fonts.setdefault(key, []).append([lines["text"]])
+                seqs.append([lines["text"]])
 
-                        else:
-                            rest_fonts[key] = rest_fonts.get(
-                                key, []) + [lines["text"]]
-                            seqs.append(lines["text"])
+            prev_size = cur_size
+            prev_font = cur_font
 
-                        prev_size = cur_size
-                        prev_font = cur_font
+    seqs = [" ".join(fragments) for fragments in seqs]
+    rest_fonts = {
+        key: [" ".join(fragments) for fragments in runs]
+        for key, runs in rest_fonts.items()
+    }
 
     sorted_fonts = dict(
         sorted(rest_fonts.items(), key=lambda x: x[0][1], reverse=True))
@@ -91,50 +121,34 @@ def get_text_nest(seqs, starting_text_nest, pdf_headers):
     Raises:
         Exception: If an error occurs during the execution of the function.
     """
+    pdf_headers = frozenset(pdf_headers)
+    # Each section's text is collected as a list of fragments and joined once
+    # at the end, instead of growing a string per sequence
+    text_fragments = {}
     cur_header = "Other"
     prev_sequence = ""
     for sequence in seqs:
         if sequence in pdf_headers:
             starting_text_nest[sequence] = ""
+            text_fragments[sequence] = [""]
             cur_header = sequence
         else:
+            section = cur_header
             if prev_sequence.startswith("Keywords"):
-                cur_header = "Keywords"
-                starting_text_nest[cur_header] = (
-                    starting_text_nest.get(cur_header, "") + " " + sequence
-                )
+                section = "Keywords"
                 cur_header = "Abstract"
-            else:
-                starting_text_nest[cur_header] = (
-                    starting_text_nest.get(cur_header, "") + " " + sequence
-                )
+            if section not in text_fragments:
+                starting_text_nest.setdefault(section, "")
+                text_fragments[section] = [starting_text_nest[section]]
+            text_fragments[section].append(sequence)
 
         prev_sequence = sequence
 
+    for header, fragments in text_fragments.items():
+        starting_text_nest[header] = " ".join(fragments)
     return starting_text_nest
 
 
-@log_traceback
-def find_earliest_uppercase_index(s):
-    """
-    Finds the index of the earliest uppercase character in a given string.
-
-    Args:
-        s (str): The input string to search for an uppercase character.
-
-    Returns:
-        int: The index of the earliest uppercase character in the string. If no uppercase character is found, returns the length of the string.
-
-    Raises:
-        Exception: If an error occurs during the execution of the function.
-
-    """
-    for i, char in enumerate(s):
-        if char.isalpha() and char.upper() == char:
-            return i
-    return len(s)
-
-
 @log_traceback
 def get_sections(doc):
     """
@@ -173,59 +187,72 @@ def make_sections_dataframe(doc):
         Exception: If an error occurs during the process, an exception is raised with the error message.
     """
     text_nest = get_sections(doc)
-    sections_df = pd.DataFrame(text_nest, index=["text"]).T
+    sections_df = pd.DataFrame(
+        {"text": list(text_nest.values())}, index=list(text_nest)
+    )
     sections_df.name = doc.name
     return text_nest, sections_df
 
 
 @log_traceback
-def find_citation_matches(author_year_pairs, full_references, data, location):
+def find_citation_matches(
+    author_year_pairs, full_references, data, location, year_index=None
+):
     """
     Finds citation matches based on author-year pairs, full references, data, and location.
 
     Args:
-        author_year_pairs (list): A list of tuples containing author names and years.
+        author_year_pairs (iterable): Tuples containing author names and years.
         full_references (list): A list of full reference strings.
         data (dict): A dictionary containing citation matches.
         location (str): A string representing the location of the citation match.
+        year_index (dict, optional): Maps a year to the references containing it.
+            It is filled in as new years are seen, so sharing it across sections
+            scans the references only once per distinct year.
 
     Returns:
         dict: A dictionary containing the updated citation matches.
     """
-
+    if year_index is None:
+        year_index = {}
     for author_year_pair in author_year_pairs:
         authors, year = author_year_pair
-        has_matched = False
-        for reference in full_references:
+        if year not in year_index:
+            year_index[year] = [
+                reference for reference in full_references if year in reference
+            ]
+        for reference in year_index[year]:
             match = True
-            if year in reference:
-                for author in authors:
-                    if author not in reference:
-                        match = False
-                if match:
-                    has_matched = True
-                    dict_value = data.get(reference, [])
-                    if dict_value == []:
-                        data[reference] = []
-                    if location not in dict_value:
-                        data[reference] = data.get(reference, []) + [location]
+            for author in authors:
+                if author not in reference:
+                    match = False
+                    break
+            if match:
+                locations = data.setdefault(reference, [])
+                if location not in locations:
+                    locations.append(location)
 
     return data
 
 
 @log_traceback
+@functools.lru_cache(maxsize=4096)
 def process_citations(citation_group: str):
     """
     Process a group of citations and extract relevant information.
 
+    The same citation group is often cited in several sections, so results are
+    cached per citation group string and returned as tuples.
+
     Args:
         citation_group (str): A string containing multiple citations separated by ';'.
 
     Returns:
-        list: A list of tuples containing the extracted information from each citation.
+        tuple: A tuple of tuples containing the extracted information from each citation.
             Each tuple consists of:
-                - A list of authors' last names.
+                - A tuple of authors' last names.
                 - The publication year.
+            Citations that could not be parsed are None.
 
     Raises:
         Exception: If an error occurs during the processing of citations.
@@ -283,32 +310,10 @@ def process_citations(citation_group: str):
         except:
             results.append(None)
 
-    return results
-
-
-@log_traceback
-def remove_prefix(citation):
-    """
-    Remove the prefix from a citation string.
-
-    Parameters:
-        citation (str): The citation string.
-
-    Returns:
-        str: The citation string without the prefix.
-
-    Raises:
-        Exception: If an error occurs in the function.
-    """
-    is_parantheses = False
-    for idx, char in enumerate(citation):
-        if char == "." and citation[idx - 1].islower() and not is_parantheses:
-            return citation[idx + 2:]
-        if char == "(":
-            is_parantheses = True
-        if char == ")":
-            is_parantheses = False
-    return citation
+    return tuple(
+        result if result is None else (tuple(result[0]), result[1])
+        for result in results
+    )
 
 
 @log_traceback
@@ -325,19 +330,13 @@ def text_preprocess_for_reference_matching(references_text):
     Raises:
         Exception: If an error occurs during preprocessing.
     """
-    references_dirty = re.sub("\n", " ", references_text)
-    references = " ".join(references_dirty.split())
-    pattern = r"(?:[\p{L}][\p{L}\s]+,(?:(?:\s|\-)[A-Z]\.){1,3}(?:,(?: . . .)?\s(?:&\s?)?)?)+ \(\d{4}\)"
-    references_clean = re.findall(pattern, references)
-    for idx, ref in enumerate(references_clean):
-        if idx == len(references_clean) - 1:
-            # All the way to the end
-            references_clean[idx] = references[references.find(ref):]
-        else:
-            next_ref = references_clean[idx + 1]
-            references_clean[idx] = references[
-                references.find(ref): references.find(next_ref)
-            ]
+    # Splitting on whitespace also takes care of newlines
+    references = " ".join(references_text.split())
+    # Each reference runs from where its match starts to where the next one
+    # starts, or all the way to the end for the last one
+    starts = [match.start() for match in REFERENCE_REGEX.finditer(references)]
+    ends = starts[1:] + [len(references)]
+    references_clean = [references[start:end] for start, end in zip(starts, ends)]
 
     return references_clean
 
@@ -361,26 +360,34 @@ def make_references_dataframe(text_nest, sections_df):
     references_dictionary = {}
     references_clean = text_preprocess_for_reference_matching(
         text_nest["References"])
-    for location, text in zip(sections_df.index, sections_df.values):
-        in_text_citations = get_in_text_citations(text.item())
+    year_index = {}
+    for location, text in sections_df["text"].items():
+        in_text_citations = get_in_text_citations(text)
         cleaned_in_text_citations = clean_in_text_citations(in_text_citations)
-        processed_citations = [
-            process_citations(citation) for citation in cleaned_in_text_citations
-        ]
-        author_year_pairs = list(
-            filter(
-                lambda x: x is not None,
-                (item for group in processed_citations for item in group),
-            )
+        # The pairs are only iterated once, so they are streamed into
+        # find_citation_matches instead of being collected in a list first
+        author_year_pairs = (
+            pair
+            for citation in cleaned_in_text_citations
+            for pair in process_citations(citation)
+            if pair is not None
         )
         references_dictionary = find_citation_matches(
-            author_year_pairs, references_clean, references_dictionary, location
+            author_year_pairs,
+            references_clean,
+            references_dictionary,
+            location,
+            year_index,
         )
 
     references_df = pd.DataFrame(
-        {k: [",".join(v)] for k, v in references_dictionary.items()},
-        index=["section"],
-    ).T.reset_index(names="reference")
+        {
+            "reference": list(references_dictionary),
+            "section": [
+                ",".join(locations) for locations in references_dictionary.values()
+            ],
+        }
+    )
     return references_df
 
 
@@ -395,14 +402,7 @@ def get_in_text_citations(text):
     Returns:
         list: A list of strings representing the in-text citations found in the text.
     """
-    IN_PARANTHESES_CITATION_REGEX = "\([&\w\\.\s,\-; ]+\s\d{3,4}(?::\s\d{1,4})?\s\)"
-    AND_PATTERN = "\S+ and \S+ \(\d{3,4}\)"
-    ONE_PATTERN = "[A-Z]\S+ \(\d{3,4}\)"
-    ET_AL_PATTERN = "[A-Z][a-z] et al. \(\d{3,4}\)"
-    IN_TEXT_CITATION_REGEX = (
-        f"{IN_PARANTHESES_CITATION_REGEX}|{AND_PATTERN}|{ONE_PATTERN}|{ET_AL_PATTERN}"
-    )
-    return re.findall(IN_TEXT_CITATION_REGEX, text)
+    return IN_TEXT_CITATION_REGEX.findall(text)
 
 
 @log_traceback
@@ -421,7 +421,10 @@ def clean_in_text_citations(in_text_citations):
     """
     cleaned_citations = []
     for citation in in_text_citations:
-        citation = re.sub(" \((\d{4})\)", r", \1", citation)
+        # Most citations have no " (Year)" part, and a substring check is much
+        # cheaper than running the substitution on them
+        if " (" in citation:
+            citation = YEAR_IN_PARANTHESES_REGEX.sub(r", \1", citation)
         if " and " in citation:
             citation = citation.replace(" and ", " & ")
         if "- " in citation:
@@ -436,8 +439,6 @@ def clean_in_text_citations(in_text_citations):
             citation = citation[22:]
         elif "e.g." in citation or "i.e." in citation:
             citation = citation[8:]
-        else:
-            citation = citation
         cleaned_citations.append(citation)
     return cleaned_citations
 
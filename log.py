@@ -13,7 +13,8 @@ def log_traceback(func):
         callable: The wrapped function that logs exceptions.
 
     Raises:
-        Exception: If an exception is raised by the wrapped function.
+        Exception: The exception raised by the wrapped function, re-raised as is
+            once it has been logged.
     """
 
     def error_logged_func(*args, **kwargs):
@@ -21,11 +22,11 @@ def log_traceback(func):
             result = func(*args, **kwargs)
             return result
         except:
+            # Format the traceback once, and keep the original exception
+            # instead of wrapping it in a new one
             logger.error(
                 f"Error occurred in '{func.__name__}': {traceback.format_exc()}"
             )
-            raise Exception(
-                f"Error occurred in '{func.__name__}': {traceback.format_exc()}"
-            )
+            raise
 
     return error_logged_func
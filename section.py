@@ -108,16 +108,30 @@ class Section:
 
     def print_contents(self) -> str:
         """
-        Recursively print the contents of the section and its children.
+        Print the contents of the section and its children.
+
+        The tree is walked with an explicit stack and the pieces are joined
+        once at the end, instead of rebuilding the text of every subtree at
+        each level of recursion.
 
         Returns:
             str: The formatted content of the section and its children.
         """
-        if len(self.children) == 0:
-            return self.content
-
-        return (
-            self.content
-            + "\n"
-            + " \n\n ".join([child.print_contents() for child in self.children])
-        )
+        parts = []
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                parts.append(item)
+                continue
+
+            parts.append(item.content)
+            if len(item.children) != 0:
+                parts.append("\n")
+                # Push the children (with separators) so they pop in order
+                for idx in range(len(item.children) - 1, -1, -1):
+                    stack.append(item.children[idx])
+                    if idx != 0:
+                        stack.append(" \n\n ")
+
+        return "".join(parts)